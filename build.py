@@ -0,0 +1,11 @@
+import sys
+from jinja2 import Environment, FileSystemLoader
+
+# Ahead-of-time compile Jinja2 templates into Python modules loaded by Kwame's ModuleLoader
+def build(template_folder='templates', target='kwame_templates'):
+    """ Compile every template in template_folder into target """
+    env = Environment(loader=FileSystemLoader(template_folder))
+    env.compile_templates(target, zip=None, ignore_errors=False)
+
+if __name__ == '__main__':
+    build(*sys.argv[1:])
@@ -1,81 +1,423 @@
 import os
+import json
+import base64
+import hashlib
+import functools
 import asyncio
-from jinja2 import Environment, FileSystemLoader
-from pydantic import BaseModel, ValidationError
-from sqlalchemy import create_engine, Column, Integer, String
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-from starlette.requests import Request
+import logging
+import logging.handlers
+import queue
+from typing import Optional
+import itsdangerous
+import orjson
+from jinja2 import ChoiceLoader, Environment, FileSystemLoader, FileSystemBytecodeCache, ModuleLoader
+from pydantic import BaseModel, ConfigDict, TypeAdapter
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, sessionmaker
+from sqlalchemy.pool import QueuePool
+from starlette.datastructures import MutableHeaders
+from starlette.requests import HTTPConnection, Request
 from starlette.responses import JSONResponse, HTMLResponse
-from starlette.routing import Route
-from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.routing import Match, Route, Router
+from starlette.middleware import Middleware
 from starlette.applications import Starlette
 import uvicorn
 import pybars
-from starlette.middleware.sessions import SessionMiddleware
+
+# Kwame logger; while the app runs, records are handed to a background thread
+# so handlers never block the event loop (see start_logging/stop_logging)
+logger = logging.getLogger("kwame")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+_log_queue = queue.SimpleQueue()
+_log_handler = logging.handlers.QueueHandler(_log_queue)
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler())
+
+def start_logging():
+    """ Start the background log thread and route kwame records to it """
+    _log_listener.start()
+    logger.addHandler(_log_handler)
+
+def stop_logging():
+    """ Flush pending records and stop the background log thread """
+    logger.removeHandler(_log_handler)
+    _log_listener.stop()
+
+# Optional native event loop, HTTP parser and WebSocket implementation (uvloop is not available on Windows)
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+try:
+    import httptools
+except ImportError:
+    httptools = None
+
+try:
+    import websockets
+except ImportError:
+    websockets = None
 
 # Database setup (SQLAlchemy ORM)
 DATABASE_URL = "sqlite:///./test.db"
 
-Base = declarative_base()
+class Base(DeclarativeBase):
+    pass
 
 # Example model for a user in the SQLite database
 class User(Base):
     __tablename__ = 'users'
-    id = Column(Integer, primary_key=True, index=True)
-    username = Column(String, index=True)
-    email = Column(String, unique=True, index=True)
+    id: Mapped[int] = mapped_column(primary_key=True, index=True)
+    username: Mapped[Optional[str]] = mapped_column(index=True)
+    email: Mapped[Optional[str]] = mapped_column(unique=True, index=True)
 
-# Create database engine and session
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+# Create database engine (pooled connections) and session factory
+engine = create_engine(
+    DATABASE_URL,
+    poolclass=QueuePool,
+    pool_size=20,
+    max_overflow=0,
+    pool_pre_ping=False,
+    connect_args={"check_same_thread": False},
+)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+@event.listens_for(engine, "connect")
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """ WAL journal with relaxed fsyncs, in-memory temp tables and mmap'd reads """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.close()
+
+# Compiled Jinja2 bytecode is persisted here across restarts
+JINJA_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'kwame_jinja')
+
+# One Handlebars compiler and compiled template cache shared by all Kwame instances
+_HANDLEBARS_COMPILER = pybars.Compiler()
+
+@functools.lru_cache(maxsize=256)
+def _compile_handlebars(compiler, source: str):
+    """ Compile a Handlebars template, cached per compiler and template source """
+    return compiler.compile(source)
+
+# Route list that tells its TrieRouter to re-index whenever it is changed
+class _RouteList(list):
+    def __init__(self, routes, on_change):
+        super().__init__(routes)
+        self._on_change = on_change
+
+def _notify_after(name):
+    def method(self, *args):
+        result = getattr(list, name)(self, *args)
+        self._on_change()
+        return result
+    method.__name__ = name
+    return method
+
+for _name in ('__setitem__', '__delitem__', '__iadd__', '__imul__', 'append', 'extend',
+              'insert', 'pop', 'remove', 'clear', 'sort', 'reverse'):
+    setattr(_RouteList, _name, _notify_after(_name))
+
+# Router that narrows the route scan with a path-segment trie
+class TrieRouter(Router):
+    def __init__(self, *args, **kwargs):
+        self._static = None  # Exact static path -> candidate routes; None when stale
+        self._exact = None  # Static paths served by exactly one plain Route
+        self._trie = None  # Parametric routes by path segment
+        self._fallback = ()  # Indexes of routes the trie can't index (mounts, {name:path} params)
+        super().__init__(*args, **kwargs)
+
+    # Mutating or replacing the public routes list (add_route, mount, app.routes.append...)
+    # marks the index stale; it is rebuilt on the next request
+    @property
+    def routes(self):
+        return self._routes
+
+    @routes.setter
+    def routes(self, routes):
+        self._routes = _RouteList(routes, self._invalidate)
+        self._invalidate()
+
+    def _invalidate(self):
+        self._static = None
+
+    @staticmethod
+    def _node():
+        return {'static': {}, 'param': None, 'indexes': []}
+
+    def _candidates(self, indexes) -> tuple:
+        """ Merge route indexes with the fallback routes, in route order """
+        return tuple(sorted(set(indexes).union(self._fallback)))
+
+    def _build_trie(self):
+        """ Precompute candidate tuples for static paths and parametric trie leaves """
+        static, parametric, fallback = {}, [], []
+        for index, route in enumerate(self.routes):
+            if not isinstance(route, Route) or ':path}' in route.path:
+                fallback.append(index)
+                continue
+            segments = route.path[1:].split('/')
+            if any('{' in segment for segment in segments):
+                parametric.append((index, segments))
+            else:
+                static.setdefault(route.path, []).append(index)
+        self._fallback = tuple(fallback)
+        self._fallback_routes = tuple(self.routes[index] for index in fallback)
+
+        self._trie = self._node()
+        for index, segments in parametric:
+            node = self._trie
+            for segment in segments:
+                if '{' in segment:
+                    if node['param'] is None:
+                        node['param'] = self._node()
+                    node = node['param']
+                else:
+                    node = node['static'].setdefault(segment, self._node())
+            node['indexes'].append(index)
+        nodes = [self._trie]
+        while nodes:
+            node = nodes.pop()
+            node['indexes'] = self._candidates(node['indexes'])
+            node['routes'] = tuple(self.routes[index] for index in node['indexes'])
+            nodes.extend(node['static'].values())
+            if node['param'] is not None:
+                nodes.append(node['param'])
+
+        # A static path can also be matched by parametric routes of the same shape
+        self._static = {}
+        for path, indexes in static.items():
+            parts = path[1:].split('/')
+            for index, segments in parametric:
+                if len(segments) == len(parts) and all(
+                        ('{' in segment and part) or segment == part
+                        for segment, part in zip(segments, parts)):
+                    indexes.append(index)
+            self._static[path] = tuple(self.routes[index] for index in self._candidates(indexes))
+        self._exact = {path: routes[0] for path, routes in self._static.items()
+                       if len(routes) == 1 and type(routes[0]).matches is Route.matches}
+
+    def find(self, path: str) -> tuple:
+        """ Return the routes that may match the path, in route order """
+        candidates = self._static.get(path)
+        if candidates is not None:
+            return candidates
+        nodes = [self._trie]
+        for segment in path[1:].split('/'):
+            next_nodes = []
+            for node in nodes:
+                child = node['static'].get(segment)
+                if child is not None:
+                    next_nodes.append(child)
+                if segment and node['param'] is not None:
+                    next_nodes.append(node['param'])
+            nodes = next_nodes
+            if not nodes:
+                return self._fallback_routes
+        if len(nodes) == 1:
+            return nodes[0]['routes']
+        indexes = self._candidates([index for node in nodes for index in node['indexes']])
+        return tuple(self.routes[index] for index in indexes)
+
+    async def app(self, scope, receive, send):
+        """ Dispatch using only the candidate routes for the request path """
+        if scope["type"] == "lifespan" or scope.get("root_path"):
+            await super().app(scope, receive, send)
+            return
+        if "router" not in scope:
+            scope["router"] = self
+        if self._static is None:
+            self._build_trie()
+
+        path = scope["path"]
+        route = self._exact.get(path)
+        if route is not None and scope["type"] == "http":
+            # The path already matched exactly, so skip the regex; Route.handle answers 405 itself
+            scope.update({"endpoint": route.endpoint, "path_params": dict(scope.get("path_params", {}))})
+            await route.handle(scope, receive, send)
+            return
+
+        partial = None
+        for route in self.find(path):
+            match, child_scope = route.matches(scope)
+            if match is Match.FULL:
+                scope.update(child_scope)
+                await route.handle(scope, receive, send)
+                return
+            if match is Match.PARTIAL and partial is None:
+                partial, partial_scope = route, child_scope
+
+        if partial is not None:  # e.g. 405 Method Not Allowed
+            scope.update(partial_scope)
+            await partial.handle(scope, receive, send)
+            return
+
+        if scope["type"] == "http" and self.redirect_slashes and path != "/":
+            redirect_path = path.rstrip("/") if path.endswith("/") else path + "/"
+            redirect_scope = {**scope, "path": redirect_path}
+            if any(route.matches(redirect_scope)[0] is not Match.NONE
+                   for route in self.find(redirect_path)):
+                # Let Starlette build the trailing-slash redirect
+                await super().app(scope, receive, send)
+                return
+        await self.default(scope, receive, send)
+
+# JSON response serialized with orjson
+class ORJSONResponse(JSONResponse):
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
+# Starlette app served by a TrieRouter. Starlette.__init__ always builds a plain Router, so it
+# is replaced straight away with a TrieRouter given the same routes and lifespan settings
+class KwameStarlette(Starlette):
+    def __init__(self, debug=False, routes=None, middleware=None, exception_handlers=None,
+                 on_startup=None, on_shutdown=None, lifespan=None):
+        super().__init__(debug=debug, routes=routes, middleware=middleware,
+                         exception_handlers=exception_handlers, on_startup=on_startup,
+                         on_shutdown=on_shutdown, lifespan=lifespan)
+        self.router = TrieRouter(routes, on_startup=on_startup, on_shutdown=on_shutdown, lifespan=lifespan)
+
+# Signed-cookie session middleware that only re-signs the cookie when the session changed
+class KwameSessionMiddleware:
+    def __init__(self, app, secret_key: str, session_cookie: str = "session",
+                 max_age: int = 14 * 24 * 60 * 60, path: str = "/",
+                 same_site: str = "lax", https_only: bool = False):
+        self.app = app
+        self.signer = itsdangerous.TimestampSigner(secret_key, digest_method=hashlib.sha256)
+        self.session_cookie = session_cookie
+        self.max_age = max_age
+        self.path = path
+        self.security_flags = "httponly; samesite=" + same_site
+        if https_only:
+            self.security_flags += "; secure"
+
+    @staticmethod
+    def encode(session: dict) -> bytes:
+        """ Serialize session data into the (unsigned) cookie payload """
+        return base64.b64encode(json.dumps(session).encode("utf-8"))
+
+    def load(self, connection: HTTPConnection):
+        """ Verify and decode the session cookie; returns the session and its payload """
+        cookie = connection.cookies.get(self.session_cookie)
+        if not cookie:
+            return {}, None
+        try:
+            payload = self.signer.unsign(cookie.encode("utf-8"), max_age=self.max_age)
+            return json.loads(base64.b64decode(payload)), payload
+        except itsdangerous.BadSignature:
+            # Unlike Starlette's SessionMiddleware, a cookie that fails verification is expired
+            # rather than left in place to be re-verified on every request. b"" never equals a
+            # real payload, so the response always carries the clearing Set-Cookie
+            return {}, b""
+
+    def dump(self, session: dict, payload: bytes) -> str:
+        """ Build the Set-Cookie header for a session payload """
+        if not session:
+            return (f"{self.session_cookie}=null; path={self.path}; "
+                    f"expires=Thu, 01 Jan 1970 00:00:00 GMT; {self.security_flags}")
+        data = self.signer.sign(payload)
+        return (f"{self.session_cookie}={data.decode('utf-8')}; path={self.path}; "
+                f"Max-Age={self.max_age}; {self.security_flags}")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+
+        scope["session"], initial_payload = self.load(HTTPConnection(scope))
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                # Comparing the serialized data also catches changes to nested values
+                session = scope["session"]
+                payload = self.encode(session) if session else None
+                if payload != initial_payload:
+                    MutableHeaders(scope=message).append("Set-Cookie", self.dump(session, payload))
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
 # Kwame Framework
 class Kwame:
-    def __init__(self, template_folder='templates', static_folder='static'):
-        self.app = Starlette(debug=True)
+    def __init__(self, template_folder='templates', static_folder='static', debug=True,
+                 compiled_template_folder='kwame_templates', bytecode_cache_folder=JINJA_CACHE_DIR):
+        self.debug = debug
+        self.app = None  # Built once by create_app()
         self.routes = []
         self.middlewares = []
-        self.env = Environment(loader=FileSystemLoader(template_folder))
-        self.handlebars = pybars.Compiler()
+        bcc = None
+        if bytecode_cache_folder:
+            try:
+                os.makedirs(bytecode_cache_folder, exist_ok=True)
+            except OSError:
+                pass  # e.g. read-only or missing $HOME; run without the bytecode cache
+            if os.access(bytecode_cache_folder, os.W_OK):
+                bcc = FileSystemBytecodeCache(directory=bytecode_cache_folder, pattern='__jinja2_%s.cache')
+        loader = FileSystemLoader(template_folder)
+        if not debug and os.path.isdir(compiled_template_folder):
+            # Templates precompiled by build.py, falling back to sources not compiled yet
+            loader = ChoiceLoader([ModuleLoader(compiled_template_folder), loader])
+        self.env = Environment(
+            loader=loader,
+            bytecode_cache=bcc,
+            auto_reload=debug,  # Skip template mtime checks outside of debug mode
+        )
+        self._template_cache = {}  # Loaded Jinja2 templates by name
+        self.handlebars = _HANDLEBARS_COMPILER
         self.template_folder = template_folder
         self.static_folder = static_folder
-        self.app.add_middleware(SessionMiddleware, secret_key="secret")  # Session middleware
-        self.db = SessionLocal()  # Initializing DB session
         
     def add_route(self, path: str, endpoint: callable, methods: list = ["GET"]):
         """ Register routes dynamically """
         route = Route(path, endpoint, methods=methods)
         self.routes.append(route)
         
-    def add_middleware(self, middleware_class: BaseHTTPMiddleware):
+    def add_middleware(self, middleware_class: type):
         """ Add middleware to the app """
         self.middlewares.append(middleware_class)
         
     def create_app(self):
         """ Create the app with the given routes and middlewares """
-        for middleware in self.middlewares:
-            self.app.add_middleware(middleware)
-        self.app.routes.extend(self.routes)
+        # Starlette matches routes in order, so serve the index route first
+        routes = sorted(self.routes, key=lambda route: route.path != '/')
+        # Last added middleware is outermost; session middleware stays innermost
+        middleware = [Middleware(cls) for cls in reversed(self.middlewares)]
+        middleware.append(Middleware(KwameSessionMiddleware, secret_key="secret"))  # Session middleware
+        self.app = KwameStarlette(debug=self.debug, routes=routes, middleware=middleware)
         return self.app
         
     def render_jinja(self, template_name: str, context: dict) -> HTMLResponse:
         """ Render Jinja2 templates """
-        template = self.env.get_template(template_name)
+        template = self._template_cache.get(template_name)
+        if template is None:
+            template = self.env.get_template(template_name)
+            if not self.debug:  # Keep auto-reload working while developing
+                self._template_cache[template_name] = template
         return HTMLResponse(template.render(context))
 
     def render_handlebars(self, template_string: str, context: dict) -> HTMLResponse:
         """ Render Handlebars templates """
-        template = self.handlebars.compile(template_string)
+        template = _compile_handlebars(self.handlebars, template_string)
         return HTMLResponse(template(context))
 
     def json_response(self, data: dict) -> JSONResponse:
         """ Return a JSON response """
-        return JSONResponse(data)
+        return ORJSONResponse(data)
     
+    def session(self):
+        """ Return a new DB session; use it as a context manager so it is closed """
+        return SessionLocal()
+
     def get_db(self):
-        """ Return DB session """
-        db = self.db
+        """ Yield a new DB session and close it when the generator is closed """
+        db = self.session()
         try:
             yield db
         finally:
@@ -89,22 +431,46 @@ class Kwame:
         """ Get session data """
         return request.session.get(key, None)
 
+# Example middleware, written as plain ASGI to avoid BaseHTTPMiddleware's per-request task and stream.
+# Not registered by default; enable it with kwame.add_middleware(MiddlewareExample)
+class MiddlewareExample:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            logger.info("Request to %s", scope["path"])
+        await self.app(scope, receive, send)
+
+# Pydantic base model that can be validated straight from a request body
+class PydanticRequestModel(BaseModel):
+    @classmethod
+    async def from_request(cls, request: Request):
+        """ Parse and validate the JSON body of a request in a single pass """
+        return cls.model_validate_json(await request.body())
+
 # Pydantic model for validation
-class UserModel(BaseModel):
+class UserModel(PydanticRequestModel):
+    model_config = ConfigDict(from_attributes=True)
+
     username: str
     email: str
 
-    class Config:
-        orm_mode = True
+# Home page body; it only depends on the session username
+def _render_home(username) -> bytes:
+    data = {'message': f'Hello, {username or "Guest"}!'}
+    return kwame.render_jinja('home.html', data).body
+
+_cached_render_home = functools.lru_cache(maxsize=1024)(_render_home)
 
 # Example Controller to interact with the database and session
 async def home_controller(request: Request):
     username = kwame.get_session(request, 'username')
-    data = {'message': f'Hello, {username or "Guest"}!'}
-    return kwame.render_jinja('home.html', data)
+    render = _render_home if kwame.debug else _cached_render_home  # Pick up template edits in debug
+    return HTMLResponse(render(username))
 
-async def handlebars_controller(request: Request):
-    handlebars_template = """
+# Static Handlebars page, rendered once at import time
+HANDLEBARS_TEMPLATE = """
     <html>
         <head><title>{{title}}</title></head>
         <body>
@@ -112,40 +478,89 @@ async def handlebars_controller(request: Request):
         </body>
     </html>
     """
-    data = {
-        'title': 'Handlebars Rendering in Kwame',
-        'message': 'This message is rendered using Handlebars on the server.'
-    }
-    return kwame.render_handlebars(handlebars_template, data)
+HANDLEBARS_DATA = {
+    'title': 'Handlebars Rendering in Kwame',
+    'message': 'This message is rendered using Handlebars on the server.'
+}
+
+async def handlebars_controller(request: Request):
+    return HTMLResponse(_HANDLEBARS_PAGE)
+
+# Blocking DB write, run in a worker thread so it doesn't stall the event loop
+def _create_user(user_data: UserModel) -> None:
+    with kwame.session() as db:  # Closes the session and returns its connection to the pool
+        db.add(User(username=user_data.username, email=user_data.email))
+        try:
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+            raise
+
+# Blocking batch insert: one commit (and fsync) for all rows
+def _create_users(users: list) -> None:
+    with kwame.session() as db:
+        db.add_all([User(username=user.username, email=user.email) for user in users])
+        try:
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+            raise
 
 # API Controller to create a user
 async def api_create_user(request: Request):
     try:
         user_data = await UserModel.from_request(request)
-        db = next(kwame.get_db())
-        db_user = User(username=user_data.username, email=user_data.email)
-        db.add(db_user)
-        db.commit()
-        db.refresh(db_user)
-        return kwame.json_response({"message": "User created successfully", "user": user_data.dict()})
+        await asyncio.to_thread(_create_user, user_data)
+        return kwame.json_response({"message": "User created successfully", "user": user_data.model_dump()})
+    except IntegrityError as e:  # e.g. the email is already registered
+        return kwame.json_response({"error": str(e.orig)})
     except ValueError as e:
         return kwame.json_response({"error": str(e)})
 
-# Initialize Kwame framework instance
-kwame = Kwame(template_folder="templates", static_folder="static")
+_user_list = TypeAdapter(list[UserModel])
+
+# API Controller to create several users in one transaction
+async def api_create_users(request: Request):
+    try:
+        users = _user_list.validate_json(await request.body())
+        await asyncio.to_thread(_create_users, users)
+        return kwame.json_response({"message": f"{len(users)} users created successfully",
+                                    "users": [user.model_dump() for user in users]})
+    except IntegrityError as e:  # e.g. duplicate emails, in the batch or already registered
+        return kwame.json_response({"error": str(e.orig)})
+    except ValueError as e:
+        return kwame.json_response({"error": str(e)})
+
+# Initialize Kwame framework instance; runs in production mode unless KWAME_DEBUG=1
+DEBUG = os.environ.get("KWAME_DEBUG", "0").lower() in ("1", "true", "yes")
+kwame = Kwame(template_folder="templates", static_folder="static", debug=DEBUG)
+_HANDLEBARS_PAGE = kwame.render_handlebars(HANDLEBARS_TEMPLATE, HANDLEBARS_DATA).body
 
 # Register routes
 kwame.add_route('/', home_controller, methods=["GET"])
 kwame.add_route('/handlebars', handlebars_controller, methods=["GET"])
 kwame.add_route('/api/create_user', api_create_user, methods=["POST"])
+kwame.add_route('/api/create_users', api_create_users, methods=["POST"])
 
 # Create the app and run with Uvicorn
 app = kwame.create_app()
 
-# Create database tables on startup
+# Start logging and create database tables on startup
 @app.on_event("startup")
 async def startup():
-    Base.metadata.create_all(bind=engine)
+    start_logging()
+    await asyncio.to_thread(Base.metadata.create_all, bind=engine)  # Keep the DDL off the event loop
+
+@app.on_event("shutdown")
+async def shutdown():
+    stop_logging()
 
 if __name__ == '__main__':
-    uvicorn.run(app, host="127.0.0.1", port=8000)
+    uvicorn.run(
+        app,
+        host="127.0.0.1",
+        port=8000,
+        loop="uvloop" if uvloop else "asyncio",
+        http="httptools" if httptools else "h11",
+        ws="websockets" if websockets else "auto",
+    )
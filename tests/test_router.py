@@ -0,0 +1,89 @@
+import pytest
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Mount, Route, Router, WebSocketRoute
+from starlette.testclient import TestClient
+
+from main import KwameStarlette, TrieRouter
+
+
+def endpoint(name):
+    async def handler(request):
+        return PlainTextResponse(f"{name}:{dict(request.path_params)}")
+    return handler
+
+
+async def websocket_endpoint(websocket):
+    await websocket.accept()
+    await websocket.send_text("ws")
+    await websocket.close()
+
+
+def make_routes():
+    return [
+        Route('/', endpoint('index')),
+        Route('/users', endpoint('users-post'), methods=['POST']),
+        Route('/users', endpoint('users-get')),
+        Route('/users/{id:int}', endpoint('user')),
+        Route('/users/me', endpoint('me')),
+        Route('/{a}/{b}', endpoint('ab')),
+        Route('/files/{p:path}', endpoint('files')),
+        Route('/item-{x}', endpoint('item')),
+        Route('/slash/', endpoint('slash')),
+        Route('/only-post', endpoint('only-post'), methods=['POST']),
+        Mount('/sub', routes=[Route('/x', endpoint('sub-x'))]),
+        WebSocketRoute('/ws', websocket_endpoint),
+    ]
+
+
+def make_client(router_class, root_path=''):
+    app = Starlette()
+    app.router = router_class(routes=make_routes())
+    return TestClient(app, root_path=root_path)
+
+
+PATHS = ['/', '/users', '/users/', '/users/5', '/users/me', '/users/abc', '/x/y', '/x/',
+         '/files/a/b', '/item-3', '/slash', '/slash/', '/only-post', '/sub/x', '/sub',
+         '/nope', '/a/b/c', '//', '/me/users']
+
+
+@pytest.mark.parametrize('root_path', ['', '/root'])
+@pytest.mark.parametrize('method', ['GET', 'POST', 'PUT'])
+@pytest.mark.parametrize('path', PATHS)
+def test_matches_stock_router(root_path, method, path):
+    responses = [
+        make_client(router_class, root_path).request(method, root_path + path, follow_redirects=False)
+        for router_class in (Router, TrieRouter)
+    ]
+    stock, trie = [(r.status_code, r.text, r.headers.get('location'), r.headers.get('allow'))
+                   for r in responses]
+    assert trie == stock
+
+
+def test_websocket_route():
+    with make_client(TrieRouter).websocket_connect('/ws') as websocket:
+        assert websocket.receive_text() == 'ws'
+
+
+def test_routes_appended_to_list_are_indexed():
+    app = Starlette()
+    app.router = TrieRouter(routes=make_routes())
+    client = TestClient(app)
+    assert client.get('/late').status_code == 404
+    app.routes.append(Route('/late', endpoint('late')))
+    assert client.get('/late').text.startswith('late')
+    app.add_route('/later', endpoint('later'))
+    assert client.get('/later').text.startswith('later')
+    app.router.routes = [Route('/replaced', endpoint('replaced'))]
+    assert client.get('/replaced').text.startswith('replaced')
+    assert client.get('/late').status_code == 404
+
+
+def test_kwame_starlette_keeps_lifespan_settings():
+    calls = []
+    app = KwameStarlette(routes=make_routes(), on_startup=[lambda: calls.append('startup')],
+                         on_shutdown=[lambda: calls.append('shutdown')])
+    assert isinstance(app.router, TrieRouter)
+    with TestClient(app) as client:
+        assert client.get('/').text.startswith('index')
+    assert calls == ['startup', 'shutdown']
@@ -0,0 +1,82 @@
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from main import KwameSessionMiddleware
+
+
+async def read(request):
+    return JSONResponse(dict(request.session))
+
+
+async def login(request):
+    request.session['username'] = 'ann'
+    request.session['cart'] = []
+    return JSONResponse({})
+
+
+async def add_to_cart(request):
+    request.session['cart'].append(1)
+    return JSONResponse({})
+
+
+async def merge(request):
+    session = request.session
+    session |= {'theme': 'dark'}
+    return JSONResponse({})
+
+
+async def logout(request):
+    request.session.clear()
+    return JSONResponse({})
+
+
+def make_client():
+    app = Starlette(
+        routes=[Route('/read', read), Route('/login', login), Route('/add', add_to_cart),
+                Route('/merge', merge), Route('/logout', logout)],
+        middleware=[Middleware(KwameSessionMiddleware, secret_key='test-secret')],
+    )
+    return TestClient(app)
+
+
+def test_read_without_session_sets_no_cookie():
+    response = make_client().get('/read')
+    assert response.json() == {}
+    assert 'set-cookie' not in response.headers
+
+
+def test_set_then_read_does_not_resign():
+    client = make_client()
+    assert 'session=' in client.get('/login').headers['set-cookie']
+    response = client.get('/read')
+    assert response.json() == {'username': 'ann', 'cart': []}
+    assert 'set-cookie' not in response.headers
+
+
+def test_nested_and_in_place_changes_are_saved():
+    client = make_client()
+    client.get('/login')
+    assert 'set-cookie' in client.get('/add').headers
+    assert 'set-cookie' in client.get('/merge').headers
+    assert client.get('/read').json() == {'username': 'ann', 'cart': [1], 'theme': 'dark'}
+
+
+def test_clear_expires_cookie():
+    client = make_client()
+    client.get('/login')
+    cookie = client.get('/logout').headers['set-cookie']
+    assert cookie.startswith('session=null;') and 'expires=Thu, 01 Jan 1970' in cookie
+    assert client.get('/read').json() == {}
+
+
+def test_tampered_cookie_is_rejected_and_cleared():
+    client = make_client()
+    client.get('/login')
+    value = client.cookies['session']
+    client.cookies.set('session', value[:-2] + ('AA' if value[-2:] != 'AA' else 'BB'))
+    response = client.get('/read')
+    assert response.json() == {}
+    assert response.headers['set-cookie'].startswith('session=null;')